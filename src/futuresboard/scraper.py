@@ -1,17 +1,29 @@
 from __future__ import annotations
 
-import hashlib
+import functools
 import hmac
+import json
 import sqlite3
 import threading
 import time
-from collections import OrderedDict
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from sqlite3 import Error
 from urllib.parse import urlencode
 
 import requests  # type: ignore
 from flask import current_app
+from requests.adapters import HTTPAdapter  # type: ignore
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+
+    # orjson parses the raw response bytes noticeably faster than the stdlib
+    _loads = orjson.loads
+except ImportError:
+    # orjson is a declared dependency, but keep working if it couldn't be built
+    _loads = json.loads
 
 
 class HTTPRequestError(Exception):
@@ -27,6 +39,44 @@ class HTTPRequestError(Exception):
         return f"Request to {self.url!r} failed. Code: {self.code}; Message: {self.msg}"
 
 
+DAY_MS = 86_400_000
+# 2020-01-01 00:00:00 UTC, where the income history starts on a fresh database
+HISTORY_START_MS = 1_577_836_800_000
+# signed into the bybit payload and sent as a header, the two must match
+BYBIT_RECV_WINDOW = "5000"
+
+# seconds; connect is kept short so that a retried connect still lands inside
+# the recv window
+CONNECT_TIMEOUT = 1
+READ_TIMEOUT = 5
+
+# a single session is shared by every request so that connections to the
+# exchange are pooled and kept alive instead of re-doing the TCP/TLS handshake
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=64,
+        # a retry replays the same signed url and timestamp, so retries are kept
+        # within the 5000 ms recv window: at most two, after a connect error
+        # (connect attempts time out after CONNECT_TIMEOUT, see dispatch_request)
+        # or a 5xx. Read timeouts and 429s are not retried (the scraper paces
+        # itself on the reported weight), and once retries run out the last
+        # response is handed back so the exchange's error code reaches
+        # HTTPRequestError. POST requests are never retried
+        max_retries=Retry(
+            total=2,
+            read=0,
+            backoff_factor=0.25,
+            status_forcelist=(500, 502, 503, 504),
+            respect_retry_after_header=False,
+            raise_on_status=False,
+        ),
+    ),
+)
+
+
 def auto_scrape(app):
     thread = threading.Thread(target=_auto_scrape, args=(app,))
     thread.daemon = True
@@ -47,107 +97,118 @@ def _auto_scrape(app):
 
 def hashing(query_string, exchange="binance", timestamp=None):
     if exchange == "bybit":
-        query_string = f"{timestamp}{current_app.config['API_KEY']}5000" + query_string
-        return hmac.new(
-            bytes(current_app.config["API_SECRET"].encode("utf-8")),
-            query_string.encode("utf-8"),
-            hashlib.sha256,
-        ).hexdigest()
-    return hmac.new(
-        bytes(current_app.config["API_SECRET"].encode("utf-8")),
+        prefix = f"{timestamp}{current_app.config['API_KEY']}{BYBIT_RECV_WINDOW}"
+        query_string = prefix + query_string
+    # hmac.digest() is OpenSSL's one-shot HMAC, no python level HMAC object is built
+    return hmac.digest(
+        current_app.config["API_SECRET"].encode("utf-8"),
         query_string.encode("utf-8"),
-        hashlib.sha256,
-    ).hexdigest()
+        "sha256",
+    ).hex()
 
 
 def get_timestamp():
-    return int(time.time() * 1000)
-
-
-def dispatch_request(http_method, signature=None, timestamp=None):
-    session = requests.Session()
-    session.headers.update(
-        {
-            "Content-Type": "application/json;charset=utf-8",
-            "X-MBX-APIKEY": current_app.config["API_KEY"],
-            "X-BAPI-API-KEY": current_app.config["API_KEY"],
-            "X-BAPI-SIGN": f"{signature}",
-            "X-BAPI-SIGN-TYPE": "2",
-            "X-BAPI-TIMESTAMP": f"{timestamp}",
-            "X-BAPI-RECV-WINDOW": "5000",
-        }
-    )
+    return time.time_ns() // 1_000_000
+
+
+def dispatch_request(http_method, signature=None, timestamp=None, exchange="binance"):
+    # headers are passed per request, the shared session must never be mutated.
+    # Public requests only get the content type, signed ones add the headers of
+    # their own exchange
+    headers = {"Content-Type": "application/json;charset=utf-8"}
+    if signature is not None:
+        if exchange == "bybit":
+            headers.update(
+                {
+                    "X-BAPI-API-KEY": current_app.config["API_KEY"],
+                    "X-BAPI-SIGN": f"{signature}",
+                    "X-BAPI-SIGN-TYPE": "2",
+                    "X-BAPI-TIMESTAMP": f"{timestamp}",
+                    "X-BAPI-RECV-WINDOW": BYBIT_RECV_WINDOW,
+                }
+            )
+        else:
+            headers["X-MBX-APIKEY"] = current_app.config["API_KEY"]
 
-    return {
-        "GET": session.get,
-        "DELETE": session.delete,
-        "PUT": session.put,
-        "POST": session.post,
-    }.get(http_method, "GET")
+    return functools.partial(
+        _SESSION.request,
+        http_method,
+        headers=headers,
+        timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+    )
 
 
 # used for sending request requires the signature
 def send_signed_request(http_method, url_path, payload={}, exchange="binance"):
-    if exchange == "binance":
-        payload["timestamp"] = get_timestamp()
-    query_string = urlencode(OrderedDict(sorted(payload.items())))
-    query_string = query_string.replace(
-        "%27", "%22"
-    )  # replace single quote to double quote
+    timestamp = get_timestamp()
+    if exchange == "binance" and not payload:
+        # the timestamp alone needs no sorting or encoding
+        query_string = f"timestamp={timestamp}"
+    else:
+        if exchange == "binance":
+            # copied, so neither the caller's dict nor the shared default is mutated
+            payload = {**payload, "timestamp": timestamp}
+        # list/dict values (e.g. symbols=["BTCUSDT"]) are sent as compact JSON
+        query_string = urlencode(
+            [
+                (key, json.dumps(value, separators=(",", ":")))
+                if isinstance(value, (list, dict))
+                else (key, value)
+                for key, value in sorted(payload.items())
+            ]
+        )
 
+    # binance signs the query string only, bybit prefixes it with the timestamp
+    # and api key; either way the signature is computed once and reused
+    signature = hashing(
+        query_string=query_string, exchange=exchange, timestamp=timestamp
+    )
     url = f"{current_app.config['API_BASE_URL']}{url_path}?{query_string}"
     if exchange == "binance":
-        url += f"&signature={hashing(query_string, exchange)}"
+        url += f"&signature={signature}"
 
     # print("{} {}".format(http_method, url))
-    params = {"url": url, "params": {}}
     try:
-        timestamp = get_timestamp()
         response = dispatch_request(
-            http_method,
-            hashing(query_string=query_string, exchange=exchange, timestamp=timestamp),
-            timestamp=timestamp,
-        )(**params)
-        headers = response.headers
-        try:
-            json_response = response.json()
-        except requests.exceptions.JSONDecodeError as e:
-            raise HTTPRequestError(url=url, code=-3, msg=f"{e}")
-        if "code" in json_response:
+            http_method, signature, timestamp=timestamp, exchange=exchange
+        )(url=url)
+    except requests.exceptions.RequestException as e:
+        raise HTTPRequestError(url=url, code=-1, msg=f"{e}")
+    try:
+        json_response = _loads(response.content)
+    except ValueError as e:
+        raise HTTPRequestError(url=url, code=-3, msg=f"{e}")
+    if "code" in json_response:
+        raise HTTPRequestError(
+            url=url, code=json_response["code"], msg=json_response["msg"]
+        )
+    if "retCode" in json_response:
+        if json_response["retCode"] != 0:
             raise HTTPRequestError(
-                url=url, code=json_response["code"], msg=json_response["msg"]
+                url=url, code=json_response["retCode"], msg=json_response["retMsg"]
             )
-        if "retCode" in json_response:
-            if json_response["retCode"] != 0:
-                raise HTTPRequestError(
-                    url=url, code=json_response["retCode"], msg=json_response["retMsg"]
-                )
-        return headers, json_response
-    except requests.exceptions.ConnectionError as e:
-        raise HTTPRequestError(url=url, code=-1, msg=f"{e}")
+    return response.headers, json_response
 
 
 # used for sending public data request
 def send_public_request(url_path, payload={}):
-    query_string = urlencode(payload, True)
     url = current_app.config["API_BASE_URL"] + url_path
-    if query_string:
-        url = url + "?" + query_string
+    if payload:
+        url = url + "?" + urlencode(payload, True)
     # print("{}".format(url))
     try:
         response = dispatch_request("GET")(url=url)
-        headers = response.headers
-        try:
-            json_response = response.json()
-        except requests.exceptions.JSONDecodeError as e:
-            raise HTTPRequestError(url=url, code=-3, msg=f"{e}")
-        if "code" in json_response:
-            raise HTTPRequestError(
-                url=url, code=json_response["code"], msg=json_response["msg"]
-            )
-        return headers, json_response
-    except requests.exceptions.ConnectionError as e:
+    except requests.exceptions.RequestException as e:
         raise HTTPRequestError(url=url, code=-2, msg=f"{e}")
+    try:
+        json_response = _loads(response.content)
+    except ValueError as e:
+        raise HTTPRequestError(url=url, code=-3, msg=f"{e}")
+    if "code" in json_response:
+        raise HTTPRequestError(
+            url=url, code=json_response["code"], msg=json_response["msg"]
+        )
+    return response.headers, json_response
 
 
 def create_connection(db_file):
@@ -313,6 +374,11 @@ def create_orders(conn, orders):
     cur.execute(sql, orders)
 
 
+def _in_app_context(app, func, *args, **kwargs):
+    with app.app_context():
+        return func(*args, **kwargs)
+
+
 def scrape(app=None):
     try:
         _scrape(app=app)
@@ -333,32 +399,48 @@ def _scrape(app=None):
     processed, updated_positions, new_positions, updated_orders, sleeps = 0, 0, 0, 0, 0
 
     if current_app.config["EXCHANGE"].lower() == "binance":
-        if weightused < 800:
-            responseHeader, responseJSON = send_signed_request(
-                "GET", "/fapi/v1/openOrders"
+        # open orders and the account snapshot don't depend on each other, so
+        # both are requested at once over the pooled session
+        flask_app = current_app._get_current_object()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            orders_request = executor.submit(
+                _in_app_context,
+                flask_app,
+                send_signed_request,
+                "GET",
+                "/fapi/v1/openOrders",
+            )
+            account_request = executor.submit(
+                _in_app_context,
+                flask_app,
+                send_signed_request,
+                "GET",
+                "/fapi/v2/account",
             )
-            weightused = int(responseHeader["X-MBX-USED-WEIGHT-1M"])
-
-            with create_connection(current_app.config["DATABASE"]) as conn:
-                delete_all_orders(conn)
-                for order in responseJSON:
-                    updated_orders += 1
-                    row = (
-                        float(order["origQty"]),
-                        float(order["price"]),
-                        order["side"],
-                        order["positionSide"],
-                        order["status"],
-                        order["symbol"],
-                        int(order["time"]),
-                        order["type"],
-                    )
-                    create_orders(conn, row)
-                conn.commit()
 
-        responseHeader, responseJSON = send_signed_request("GET", "/fapi/v2/account")
+        responseHeader, responseJSON = orders_request.result()
         weightused = int(responseHeader["X-MBX-USED-WEIGHT-1M"])
 
+        with create_connection(current_app.config["DATABASE"]) as conn:
+            delete_all_orders(conn)
+            for order in responseJSON:
+                updated_orders += 1
+                row = (
+                    float(order["origQty"]),
+                    float(order["price"]),
+                    order["side"],
+                    order["positionSide"],
+                    order["status"],
+                    order["symbol"],
+                    int(order["time"]),
+                    order["type"],
+                )
+                create_orders(conn, row)
+            conn.commit()
+
+        responseHeader, responseJSON = account_request.result()
+        weightused = max(weightused, int(responseHeader["X-MBX-USED-WEIGHT-1M"]))
+
         overweight = False
         try:
             positions = responseJSON["positions"]
@@ -411,10 +493,7 @@ def _scrape(app=None):
             with create_connection(current_app.config["DATABASE"]) as conn:
                 startTime = select_latest_income(conn)
                 if startTime is None:
-                    startTime = int(
-                        datetime.fromisoformat("2020-01-01 00:00:00+00:00").timestamp()
-                        * 1000
-                    )
+                    startTime = HISTORY_START_MS
                 else:
                     startTime = startTime[0]
 
@@ -603,6 +682,7 @@ def _scrape(app=None):
                 app.logger.warning("Wallet: 'result' not in responseJSON")
 
         all_symbols = sorted(all_symbols)
+        two_years_ago_timestamp = get_timestamp() - 729 * DAY_MS
         app.logger.info("Updating closed PnL from exchange")
         for symbol in all_symbols:
             trades = {}
@@ -613,13 +693,8 @@ def _scrape(app=None):
             }
             with create_connection(current_app.config["DATABASE"]) as conn:
                 startTime = select_latest_income_symbol(conn, symbol)
-                two_years_ago = datetime.now() - timedelta(days=729)
-                two_years_ago_timestamp = int(two_years_ago.timestamp() * 1000)
                 if startTime is None:
-                    startTime = int(
-                        datetime.fromisoformat("2020-01-01 00:00:00+00:00").timestamp()
-                        * 1000
-                    )
+                    startTime = HISTORY_START_MS
                 else:
                     startTime = int(startTime[0]) + 1
 
@@ -678,7 +753,7 @@ def _scrape(app=None):
                 break
 
             if len(trades) > 0:
-                trades = OrderedDict(sorted(trades.items()))
+                trades = dict(sorted(trades.items()))
                 with create_connection(current_app.config["DATABASE"]) as conn:
                     for trade in trades:
                         income_row = (